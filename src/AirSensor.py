@@ -1,32 +1,134 @@
 from gpiozero import MCP3008
 import time
 import numpy as np
-from scipy.optimize import curve_fit
 import os
 import json
+import threading
+import spidev
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DIR = "/home/dhenl2/Auto-Compressor/src"
 
+# MCP3008 wiring, same bus/device gpiozero's MCP3008 defaults to
+SPI_PORT = 0
+SPI_DEVICE = 0
+SPI_MAX_SPEED_HZ = 1_000_000
+MCP3008_MAX_VALUE = 1023
+MCP3008_SCALE = 1.0 / MCP3008_MAX_VALUE
+
+# Background sampling of the raw ADC value
+SAMPLE_INTERVAL = 0.005     # (s)
+# samples per update, the highest and lowest of which are discarded as outliers
+SAMPLE_BATCH = 8
+# a filtered value older than this means the sampler has stalled
+SAMPLE_MAX_AGE = 20 * SAMPLE_INTERVAL   # (s)
+# Default Kalman filter noise, in raw ADC units (0-1)
+MEASUREMENT_VARIANCE = 4e-6
+PROCESS_VARIANCE = 1e-3
+
+def write_json(path, obj):
+    """
+    Write obj to path as indented JSON. Uses orjson when it is installed, which serialises NumPy
+    arrays natively, otherwise falls back to the standard library.
+    :param path: File path to write to
+    :param obj: JSON serialisable object, NumPy arrays are allowed
+    """
+
+    if orjson is not None:
+        with open(path, "wb") as file:
+            file.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(path, "w") as file:
+            file.write(json.dumps(obj, indent=2, default=lambda value: value.tolist()))
+
+def decode_mcp3008(rx):
+    """
+    Decode the responses of back to back MCP3008 transfers. Each 3 byte frame holds the top 2 bits of the
+    10-bit result in the low bits of byte 1 and the remaining 8 bits in byte 2.
+    :param rx: Received bytes, a multiple of 3 long
+    :return: Array of readings scaled to 0-1
+    """
+
+    frames = np.frombuffer(rx, dtype=np.uint8).reshape(-1, 3)
+    samples = ((frames[:, 1].astype(np.uint16) & 0x03) << 8) | frames[:, 2]
+    return samples * MCP3008_SCALE
+
+class SensorError(Exception):
+    pass
+
+class KalmanFilter:
+    """
+    Kalman filter tracking a value and its rate of change, assuming the rate changes as white noise.
+    Kept to scalar arithmetic as the 2x2 matrices are too small for NumPy to pay off.
+    """
+
+    def __init__(self, measurement_var, process_var):
+        self.measurement_var = measurement_var
+        self.process_var = process_var
+        self.value = None
+        self.rate = 0.0
+        self.t = None
+        # covariance of (value, rate)
+        self.p00 = measurement_var
+        self.p01 = 0.0
+        self.p11 = process_var
+
+    def update(self, measurement, t):
+        if self.value is None:
+            self.value = measurement
+            self.t = t
+            return self.value
+
+        dt = t - self.t
+        self.t = t
+        q = self.process_var
+
+        # predict
+        value = self.value + self.rate * dt
+        p00 = self.p00 + dt * (2 * self.p01 + dt * self.p11) + q * dt * dt * dt / 3
+        p01 = self.p01 + dt * self.p11 + q * dt * dt / 2
+        p11 = self.p11 + q * dt
+
+        # correct
+        s = p00 + self.measurement_var
+        k0 = p00 / s
+        k1 = p01 / s
+        residual = measurement - value
+        self.value = value + k0 * residual
+        self.rate += k1 * residual
+        self.p00 = (1 - k0) * p00
+        self.p01 = (1 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        return self.value
+
 class CalibrationData:
     def __init__(self, air_pressure):
         self.air_pressure = air_pressure
-        self.data = []
+        self.data = np.empty(0)
         self.avg = -1
         self.var = -1
         self.std = -1
 
     def read_for(self, sensor, duration, read_num):
         interval = duration / read_num
+        self.data = np.empty(read_num)
 
-        while len(self.data) != read_num:
-            self.data.append(sensor.value)
-            time.sleep(interval)
+        # schedule each sample against a fixed deadline so the read time doesn't accumulate as drift
+        start = time.perf_counter()
+        for k in range(read_num):
+            time.sleep(max(0.0, start + k * interval - time.perf_counter()))
+            self.data[k] = sensor.value
 
     def calculate(self):
-        np_array = np.array(self.data)
-        self.avg = np.average(np_array)
-        self.std = np.std(np_array)
-        self.var = np.var(np_array)
+        # derive all three moments from the sum and sum of squares rather than a pass each
+        n = self.data.size
+        self.avg = self.data.sum() / n
+        self.var = max(np.dot(self.data, self.data) / n - self.avg * self.avg, 0.0)
+        self.std = np.sqrt(self.var)
 
     def __str__(self):
         print(
@@ -36,22 +138,26 @@ class CalibrationData:
             f"\tStandard Deviation: {self.std:.2f}\n")
 
     def save(self):
-        with open(f"{DIR}/calibrationData/{self.air_pressure}_data.json", "w") as save:
-            to_write = {
-                "name": self.air_pressure,
-                "data": self.data,
-                "average": self.avg,
-                "variance": self.var,
-                "standardDeviation": self.std
-            }
-            save.write(json.dumps(to_write, indent=2))
+        write_json(f"{DIR}/calibrationData/{self.air_pressure}_data.json", {
+            "name": self.air_pressure,
+            "data": self.data,
+            "average": self.avg,
+            "variance": self.var,
+            "standardDeviation": self.std
+        })
 
 class AirSensor:
     def __init__(self, logger):
         self.calib_save = "calibration.json"
+        self._calib_path = os.path.join(DIR, "calibrationData", self.calib_save)
         self.channel = 0
         self.sensor = None
+        self.spi = None
         self.logger = logger
+        # filtered raw ADC value and rate, only written by the sampler thread
+        self._filter = None
+        self._sampler = None
+        self._sampler_error = None
         # y = mx + c
         self.m = None       # gradient
         self.c = None       # offset
@@ -75,10 +181,36 @@ class AirSensor:
         self.units = config["units"]
         self.channel = config["channel"]
         self.sensor = MCP3008(self.channel)
+        self.spi = spidev.SpiDev()
+        self.spi.open(SPI_PORT, SPI_DEVICE)
+        self.spi.max_speed_hz = SPI_MAX_SPEED_HZ
         self.logger.info(
             f"Air Sensor configured as (m, c, units, channel) ({self.m}, {self.c}, {self.units}, {self.channel})")
 
+        # seed the filter so readers never see an empty value, then keep it updated in the background
+        self._filter = KalmanFilter(
+            config.get("measurement_variance", MEASUREMENT_VARIANCE),
+            config.get("process_variance", PROCESS_VARIANCE))
+        self._filter.update(float(self.read_batch(20).mean()), time.perf_counter())
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        try:
+            while True:
+                samples = np.sort(self.read_batch(SAMPLE_BATCH))
+                self._filter.update(float(samples[1:-1].mean()), time.perf_counter())
+                time.sleep(SAMPLE_INTERVAL)
+        except Exception as error:
+            # kept for read_sensor to raise, the thread has no caller to report to
+            self._sampler_error = error
+
     def read_sensor(self):
+        if self._sampler_error is not None:
+            raise SensorError("Air sensor sampling stopped") from self._sampler_error
+        age = time.perf_counter() - self._filter.t
+        if age > SAMPLE_MAX_AGE:
+            raise SensorError(f"Air sensor reading is {age:.3f}s old, sampling has stalled")
         pressure = self.get_avg_reading()
         if pressure < 0:
             # Log pressure is less than 0
@@ -87,39 +219,44 @@ class AirSensor:
 
         return pressure
 
-    def get_reading(self, x=None, m=None, c=None):
-        if x is None:
-            x = self.sensor.value
-            m = self.m
-            c = self.c
+    def get_reading(self):
+        return (self.m * self.sensor.value) + self.c
+
+    def read_batch(self, num_samples):
+        """
+        Read num_samples conversions straight off the SPI bus, bypassing gpiozero's per read overhead.
+        The MCP3008 only converts once per chip select, so each sample is its own 3 byte transfer.
+        :param num_samples: Number of samples to read
+        :return: Array of readings scaled to 0-1, the same scale as MCP3008.value
+        """
 
-        return (m * x) + c
+        xfer2 = self.spi.xfer2
+        command = [0x01, 0x80 | (self.channel << 4), 0x00]
+        rx = bytearray()
+        for _ in range(num_samples):
+            rx.extend(xfer2(command))
 
-    def get_avg_reading(self, num_samples=20):
-        samples = []
-        while len(samples) < num_samples:
-            samples.append(self.get_reading())
+        return decode_mcp3008(rx)
 
-        return np.average(np.array(samples))
+    def get_avg_reading(self):
+        # Returns the sampler's latest estimate immediately rather than waiting on fresh conversions.
+        # y = mx + c is linear so it commutes with the filter, only apply it once to the filtered raw value
+        return self.m * self._filter.value + self.c
 
     def has_calibration(self):
-        return self.calib_save in os.listdir(f"{DIR}/calibrationData")
+        return os.path.isfile(self._calib_path)
 
     def save_calibration(self):
-        with open(f"{DIR}/calibrationData/{self.calib_save}", "w") as save_file:
-            save_file.write(
-                json.dumps({
-                    "equation": f"y = {self.m}.x + {self.c}",
-                    "m": self.m,
-                    "c": self.c,
-                    "units": self.units
-                }, indent=2)
-            )
+        write_json(self._calib_path, {
+            "equation": f"y = {self.m}.x + {self.c}",
+            "m": self.m,
+            "c": self.c,
+            "units": self.units
+        })
 
     def load_calibration(self):
-        file_path = f"{DIR}/calibrationData/{self.calib_save}"
-        self.logger.info(f"Loading calibration data from {file_path}")
-        with open(file_path, "r") as file:
+        self.logger.info(f"Loading calibration data from {self._calib_path}")
+        with open(self._calib_path, "r") as file:
             json_obj = json.load(file)
             self.m = json_obj["m"]
             self.c = json_obj["c"]
@@ -160,10 +297,11 @@ class AirSensor:
         print("Calculating linear equation from\n" +
               f"\tx:{readings}\n" +
               f"\ty:{air_pressures}")
-        popt, _ = curve_fit(self.get_reading, readings, air_pressures)
-        print(f"Calculated m_x = {popt[0]}, c = {popt[1]}")
-        self.m = popt[0]
-        self.c = popt[1]
+        # the model is linear so a least squares line fit solves it directly
+        m, c = np.polyfit(np.asarray(readings, dtype=np.float64), np.asarray(air_pressures, dtype=np.float64), 1)
+        print(f"Calculated m_x = {m}, c = {c}")
+        self.m = float(m)
+        self.c = float(c)
 
 def get_reading(x, m, c):
     return (m * x) + c
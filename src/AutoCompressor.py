@@ -1,8 +1,16 @@
 #! /usr/bin/python3.9
+import asyncio
+import atexit
 import configparser
+import gc
+import glob
+import math
+import os
 import sys
 import signal
 import time
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
 from loguru import logger
 from datetime import timedelta
 import RPi.GPIO as GPIO
@@ -21,9 +29,24 @@ RC_OUTLET = "outlet"
 
 # Number of moles per m3 of air on average
 # https://www.quora.com/How-many-air-molecules-are-present-in-a-cubic-meter-of-air
-MOLES_PER_M3 = 0.0042 * (10 ** 3)
+MOLES_PER_M3 = 4.2                  # 0.0042 * 10^3
 # https://www.khanacademy.org/science/physics/thermodynamics/temp-kinetic-theory-ideal-gas-law/a/what-is-the-ideal-gas-law
 UNIVERSAL_GAS_CONSTANT = 8.3145
+PSI_TO_PA = 6894.76
+PA_TO_PSI = 1.0 / PSI_TO_PA
+# Shortest pulse the valves can meaningfully deliver, shorter estimates are raised to this
+MIN_ACTUATION_TIME = 0.05           # (s)
+# Valve timings sleep until this close to their deadline then spin. asyncio rounds its epoll timeout up to
+# whole milliseconds, so the margin has to cover that rounding.
+SPIN_MARGIN = 0.002                 # (s)
+# SCHED_FIFO priority used while actuating valves
+REALTIME_PRIORITY = 20
+# CPU frequency governors, writing these needs root
+CPU_GOVERNOR_FILES = "/sys/devices/system/cpu/cpu*/cpufreq/scaling_governor"
+# Smallest pressure change the initial estimation can be based on, below this it's sensor noise
+MIN_PRESSURE_CHANGE = 0.1           # (PSI)
+# Weight kept by the previous rate estimate when blending in an observed one
+RATE_BLEND = 0.5
 
 def flow_rate_in_moles(rate, logger):
     """
@@ -33,7 +56,7 @@ def flow_rate_in_moles(rate, logger):
     """
 
     result = rate * MOLES_PER_M3
-    logger.trace(f"{rate} L/s to mols = {result}")
+    logger.trace("{} L/s to mols = {}", rate, result)
     return result
 
 def determine_mols_pressure_diff(p1, p2, t, flow_rate, logger):
@@ -58,7 +81,7 @@ def determine_mols_pressure_diff(p1, p2, t, flow_rate, logger):
     """
 
     result = (flow_rate * p1 * t) / (p2 - p1)
-    logger.trace(f"Calculate mols pressure difference: (p1, p2, flow_rate) ({p1}, {p2}, {flow_rate}) = {result}")
+    logger.trace("Calculate mols pressure difference: (p1, p2, flow_rate) ({}, {}, {}) = {}", p1, p2, flow_rate, result)
     return result
 
 def determine_mols(v, p, T, logger):
@@ -84,7 +107,7 @@ def determine_mols(v, p, T, logger):
     """
 
     result = (p * v) / (UNIVERSAL_GAS_CONSTANT * T)
-    logger.trace(f"Determine mols: (v, p, T) ({v}, {p}, {T}) = {result}")
+    logger.trace("Determine mols: (v, p, T) ({}, {}, {}) = {}", v, p, T, result)
     return result
 
 def est_time_to_target(p1, p2, n0, flow_rate, logger):
@@ -108,7 +131,7 @@ def est_time_to_target(p1, p2, n0, flow_rate, logger):
     """
 
     result = abs((n0 * (p2 - p1)) / (flow_rate * p1))
-    logger.trace(f"Est. time to target: (p1, p2, n0, flow_rate) ({p1}, {p2}, {n0}, {flow_rate}) = {result}")
+    logger.trace("Est. time to target: (p1, p2, n0, flow_rate) ({}, {}, {}, {}) = {}", p1, p2, n0, flow_rate, result)
     return result
 
 def determine_volume(p, n, T, logger):
@@ -131,7 +154,7 @@ def determine_volume(p, n, T, logger):
     """
 
     result = (n * UNIVERSAL_GAS_CONSTANT * T) / p
-    logger.trace(f"Determine volume: (p, n, T) ({p}, {n}, {T}) = {result}")
+    logger.trace("Determine volume: (p, n, T) ({}, {}, {}) = {}", p, n, T, result)
     return result
 
 def psi_pa(pressure):
@@ -141,7 +164,7 @@ def psi_pa(pressure):
     :return: Pressure in Pa
     """
 
-    return pressure * 6894.76
+    return pressure * PSI_TO_PA
 
 def pa_psi(pressure):
     """
@@ -150,11 +173,136 @@ def pa_psi(pressure):
     :return: Pressure in PSI
     """
     
-    return pressure / 6894.76
+    return pressure * PA_TO_PSI
 
 def celsius_to_kelvin(temp):
     return temp + 273.15
 
+def set_cpu_governor(governor, logger):
+    """
+    Set the frequency governor of every CPU, so frequency scaling doesn't stretch valve timings.
+    CPUs whose governor can't be written are left as they are.
+    :param governor: Governor to set
+    :return: Dict of governor file to the governor it had before, only for files that were changed
+    """
+
+    previous = {}
+    for path in glob.glob(CPU_GOVERNOR_FILES):
+        try:
+            with open(path, "r+") as file:
+                current = file.read().strip()
+                if current != governor:
+                    file.seek(0)
+                    file.write(governor)
+                    previous[path] = current
+        except OSError:
+            continue
+    if previous:
+        logger.debug("Set CPU governor of {} CPUs to {}", len(previous), governor)
+    return previous
+
+def restore_cpu_governors(previous, logger):
+    """
+    Put back the governors changed by set_cpu_governor
+    :param previous: Dict of governor file to governor as returned by set_cpu_governor
+    """
+
+    for path, governor in previous.items():
+        try:
+            with open(path, "w") as file:
+                file.write(governor)
+        except OSError:
+            logger.warning("Unable to restore CPU governor {} in {}", governor, path)
+    if previous:
+        logger.debug("Restored the CPU governor of {} CPUs", len(previous))
+
+@contextmanager
+def realtime_priority(logger, priority=REALTIME_PRIORITY, cpu=None):
+    """
+    Run the calling thread under SCHED_FIFO pinned to a single CPU, restoring the previous scheduling on exit.
+    Falls back to the highest nice value if real time scheduling isn't permitted, and to no change at all
+    if neither is.
+    :param priority: SCHED_FIFO priority to run at
+    :param cpu: CPU to pin to, defaults to the last CPU. This can be a CPU isolated with isolcpus.
+    """
+
+    policy = os.sched_getscheduler(0)
+    param = os.sched_getparam(0)
+    affinity = os.sched_getaffinity(0)
+    if cpu is None:
+        cpu = os.cpu_count() - 1
+    niceness = None
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        # pin to one core so the scheduler doesn't migrate us mid actuation
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except OSError:
+            # CPU isn't available to this process, stay on one that is
+            cpu = max(affinity)
+            os.sched_setaffinity(0, {cpu})
+        logger.debug(f"Running at SCHED_FIFO priority {priority} on CPU {cpu}")
+    except PermissionError:
+        try:
+            niceness = os.nice(0)
+            os.nice(-20 - niceness)
+            logger.debug("Real time scheduling not permitted, running at nice -20")
+        except PermissionError:
+            niceness = None
+            logger.warning("Unable to raise scheduling priority, valve timings may jitter")
+
+    try:
+        yield
+    finally:
+        os.sched_setscheduler(0, policy, param)
+        os.sched_setaffinity(0, affinity)
+        if niceness is not None:
+            os.nice(niceness - os.nice(0))
+
+@contextmanager
+def gc_paused():
+    """
+    Hold off the cyclic garbage collector, so a collection can't land between opening and closing a valve
+    """
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+@dataclass(frozen=True)
+class CompressorConfig:
+    """
+    Typed values of the compressor section of the config, parsed once at load time
+    """
+
+    __slots__ = ("init_check_inflate", "init_check_deflate", "error_margin", "flow_rate_in", "flow_rate_out",
+                 "on_delay", "pressure_balance_delay", "temperature", "control_step_max", "max_rounds", "trim_max")
+
+    init_check_inflate: float           # (s)
+    init_check_deflate: float           # (s)
+    error_margin: float
+    flow_rate_in: float                 # (L/s)
+    flow_rate_out: float                # (L/s)
+    on_delay: float                     # (s)
+    pressure_balance_delay: float       # (s)
+    temperature: float                  # (C°)
+    control_step_max: float             # (s) optional, defaults to 4 * pressure_balance_delay
+    max_rounds: int                     # optional, defaults to 3
+    trim_max: float                     # (s) optional, defaults to control_step_max, i.e. no extra limit
+
+    @classmethod
+    def from_section(cls, section):
+        values = {field.name: section.getint(field.name) if field.type is int else section.getfloat(field.name)
+                  for field in fields(cls) if field.name in section}
+        values.setdefault("control_step_max", values["pressure_balance_delay"] * 4)
+        values.setdefault("max_rounds", 3)
+        values.setdefault("trim_max", values["control_step_max"])
+        return cls(**values)
+
 class AutoCompressor:
     """
     Auto Compressor Object to control the automation of inflation and deflation
@@ -165,19 +313,33 @@ class AutoCompressor:
         GPIO.cleanup()
         GPIO.setmode(GPIO.BOARD)
         self.config = configparser.ConfigParser()
-        self.config.read(config_file)
+        if not self.config.read(config_file):
+            raise FileNotFoundError(f"Unable to read config file {config_file}")
         self.relay_controller = None
         self.air_sensor = None
 
         # Compressor variables
         self.init_deflate_dur = None                # (s)
         self.init_inflate_dur = None                # (s)
-        self.flow_rate_in = None                    # (L/s)
-        self.flow_rate_out = None                   # (L/s)
-        self.on_delay = None                        # (s)
+        self.flow_rate_in = None                    # (mol/s)
+        self.flow_rate_out = None                   # (mol/s)
+        self.on_delay = None                        # (s) inlet dead time before air flows
         self.pressure_balance_delay = None          # (s)
+        self.control_step_max = None                # (s)
+        self.max_rounds = None                      # unclipped landing attempts before giving up
+        self.trim_max = None                        # (s) longest correction after the first landing attempt
         self.error_margin = None                    # (%)
-        self.ambient_temperature = None             # (C°)
+        self.ambient_temperature = None             # (K)
+        self._RT = None                             # R * T
+        self._RT_inv = None                         # 1 / (R * T)
+        self._inv_flow_in = None                    # 1 / flow_rate_in
+        self._inv_flow_out = None                   # 1 / flow_rate_out
+        self._last_valve_change = float("-inf")     # time.perf_counter() of the last valve change
+        # mirror of the valve relay states so unchanged states skip the relay controller
+        self._valve_open = {RC_INLET: False, RC_OUTLET: False}
+        self._relay_on = None
+        self._relay_off = None
+        self._units = None                          # air sensor units, fixed once the sensor is configured
 
         self.initialise()
 
@@ -187,208 +349,345 @@ class AutoCompressor:
 
     def initialise(self):
         # logger
-        logger.remove()
-        logger.add(
-            sink=self.config[CONFIG_LOGGER]["file"],
+        logger_config = self.config[CONFIG_LOGGER]
+        log_level = logger_config["level"].upper()
+        self.logger.remove()
+        self.logger.add(
+            sink=logger_config["file"],
             rotation=timedelta(days=1),
-            level=self.config[CONFIG_LOGGER]["level"].upper(),
+            level=log_level,
             colorize=True
         )
-        if bool(self.config[CONFIG_LOGGER]["stdout"]):
-            logger.add(
+        # getboolean so "False" in the config disables stdout, any non empty string is truthy to bool()
+        if logger_config.getboolean("stdout", fallback=False):
+            self.logger.add(
                 sink=sys.stdout,
-                level=self.config[CONFIG_LOGGER]["level"].upper()
+                level=log_level
             )
         self.logger.info("Initialising AutoCompressor...")
 
         # initialise air sensor
         self.air_sensor = AirSensor(self.logger)
+        sensor_section = self.config[CONFIG_AIR_SENSOR]
         sensor_config = {
-            "m": float(self.config[CONFIG_AIR_SENSOR]["m"]),
-            "c": float(self.config[CONFIG_AIR_SENSOR]["c"]),
-            "units": self.config[CONFIG_AIR_SENSOR]["units"],
-            "channel": int(self.config[CONFIG_AIR_SENSOR]["AO_channel"])
+            "m": sensor_section.getfloat("m"),
+            "c": sensor_section.getfloat("c"),
+            "units": sensor_section["units"],
+            "channel": sensor_section.getint("AO_channel")
         }
+        for key in ("measurement_variance", "process_variance"):
+            if key in sensor_section:
+                sensor_config[key] = sensor_section.getfloat(key)
         self.air_sensor.load_config(sensor_config)
+        self._units = self.air_sensor.units
 
         # initialise relay controller
         self.relay_controller = RelayController(self.logger)
+        relay_section = self.config[CONFIG_RELAY_CONTROLLER]
         relay_config = {
-            "max_channels": int(self.config[CONFIG_RELAY_CONTROLLER]["max_channels"]),
+            "max_channels": relay_section.getint("max_channels"),
         }
-        if self.config[CONFIG_RELAY_CONTROLLER].get("registers") is not None:
+        if relay_section.get("registers") is not None:
             # Load registers from config
-            relay_config["registers"] = self.config[CONFIG_RELAY_CONTROLLER]["registers"]
+            relay_config["registers"] = relay_section["registers"]
             self.relay_controller.load_config(relay_config)
         else:
             self.relay_controller.load_config(relay_config)
             self.relay_controller.register(
                 RC_INLET,
-                int(self.config[CONFIG_RELAY_CONTROLLER]["inlet_pin"]),
-                int(self.config[CONFIG_RELAY_CONTROLLER]["inlet_off_state"])
+                relay_section.getint("inlet_pin"),
+                relay_section.getint("inlet_off_state")
             )
             self.relay_controller.register(
                 RC_OUTLET,
-                int(self.config[CONFIG_RELAY_CONTROLLER]["outlet_pin"]),
-                int(self.config[CONFIG_RELAY_CONTROLLER]["outlet_off_state"])
+                relay_section.getint("outlet_pin"),
+                relay_section.getint("outlet_off_state")
             )
 
         self.relay_controller.init()
+        self._relay_on = self.relay_controller.set_relay_on
+        self._relay_off = self.relay_controller.set_relay_off
 
         # compressor variables
-        self.init_inflate_dur = float(self.config[CONFIG_COMPRESSOR]["init_check_inflate"])
-        self.init_deflate_dur = float(self.config[CONFIG_COMPRESSOR]["init_check_deflate"])
-        self.flow_rate_in = float(flow_rate_in_moles(float(self.config[CONFIG_COMPRESSOR]["flow_rate_in"]), self.logger))
-        self.flow_rate_out = float(self.config[CONFIG_COMPRESSOR]["flow_rate_out"])
-        self.on_delay = float(self.config[CONFIG_COMPRESSOR]["on_delay"])
-        self.error_margin = float(self.config[CONFIG_COMPRESSOR]["error_margin"])
-        self.pressure_balance_delay = float(self.config[CONFIG_COMPRESSOR]["pressure_balance_delay"])
+        compressor_config = CompressorConfig.from_section(self.config[CONFIG_COMPRESSOR])
+        self.init_inflate_dur = compressor_config.init_check_inflate
+        self.init_deflate_dur = compressor_config.init_check_deflate
+        self.flow_rate_in = flow_rate_in_moles(compressor_config.flow_rate_in, self.logger)
+        self.flow_rate_out = flow_rate_in_moles(compressor_config.flow_rate_out, self.logger)
+        if self.flow_rate_in <= 0 or self.flow_rate_out <= 0:
+            # both are magnitudes, the direction comes from whether the system is inflating or deflating
+            raise ValueError(f"Flow rates must be positive, got (in, out) ({self.flow_rate_in}, "
+                             f"{self.flow_rate_out}) mol/s")
+        self.on_delay = compressor_config.on_delay
+        self.error_margin = compressor_config.error_margin
+        self.pressure_balance_delay = compressor_config.pressure_balance_delay
+        self.control_step_max = compressor_config.control_step_max
+        self.max_rounds = compressor_config.max_rounds
+        self.trim_max = compressor_config.trim_max
 
         # assumptions
-        self.ambient_temperature = celsius_to_kelvin(float(self.config[CONFIG_COMPRESSOR]["temperature"]))
+        self.ambient_temperature = celsius_to_kelvin(compressor_config.temperature)
+        self._RT = UNIVERSAL_GAS_CONSTANT * self.ambient_temperature
+        self._RT_inv = 1.0 / self._RT
+        self._inv_flow_in = 1.0 / self.flow_rate_in
+        self._inv_flow_out = 1.0 / self.flow_rate_out
 
         self.logger.info("Finished initialising")
 
-    def reach_target(self, target):
-        units = self.air_sensor.units
-        p_curr = self.check_pressure(raw=True)
-        self.logger.info(f"Inflate/deflate to target {target}{units} from {round(p_curr, 2)}{units}")
+    async def reach_target(self, target):
+        """
+        Inflate/deflate until the pressure is within error_margin of target
+        :param target: Target pressure in the air sensor's units
+        :return: True if the target was reached, False if it gave up with the pressure outside the margin
+        """
+
+        with realtime_priority(self.logger):
+            return await self._reach_target(target)
+
+    def reach_target_sync(self, target):
+        """
+        Blocking reach_target for callers that aren't running an event loop
+        :param target: Target pressure in the air sensor's units
+        :return: True if the target was reached, False if it gave up with the pressure outside the margin
+        """
+
+        return asyncio.run(self.reach_target(target))
+
+    async def _reach_target(self, target):
+        units = self._units
+        # bind the run's context once so structured sinks get it on every record without per call kwargs
+        log = self.logger.bind(target=target, units=units)
+        p_curr = await self.check_pressure(raw=True)
+        log.info(f"Inflate/deflate to target {target}{units} from {p_curr:.2f}{units}")
         if target is None:
-            raise Exception(f"Target {self.air_sensor.units} not given")
+            raise Exception(f"Target {units} not given")
         elif round(p_curr) == target:
-            self.logger.info(f"Current reading of {round(p_curr)}{units} is already at target of {target}{units}")
-            return
-        target_pascal = psi_pa(target)
+            log.info(f"Current reading of {p_curr:.0f}{units} is already at target of {target}{units}")
+            return True
+        target_pascal = target * PSI_TO_PA
 
         # determine initial mol value
-        p_curr_pascal = psi_pa(p_curr)
-        init_mols = self.determine_current_mol(p_curr_pascal, target_pascal)
-        # determine current volume based off estimation
-        p_curr_pascal = psi_pa(self.check_pressure(raw=True))
-        self.logger.trace(f"Current pressure {p_curr} Pa")
-        volume = determine_volume(p_curr_pascal, init_mols, self.ambient_temperature, self.logger)
-        self.logger.debug(f"Estimated current mols as {init_mols} and volume as {volume} m3")
+        p_curr_pascal = p_curr * PSI_TO_PA
+        init_mols, p_curr_pascal = await self.determine_current_mol(p_curr_pascal, target_pascal)
+        # determine current volume based off estimation, reusing the reading taken after the estimation pulse
+        log.trace("Current pressure {} Pa", p_curr_pascal)
+        # determine_volume with R * T precomputed
+        volume = init_mols * self._RT / p_curr_pascal
+        log.debug(f"Estimated current mols as {init_mols} and volume as {volume} m3")
+        # t = V * (p2 - p1) / (R * T * flow_rate), est_time_to_target with n0 = p1 * V / (R * T) substituted,
+        # folded down to seconds per unit of pressure change for each direction. These
+        # seed the loop, which then refines them from observed pressure changes. Folding PSI_TO_PA in as well
+        # lets the loop work on sensor readings without converting them.
+        mols_per_psi = volume * self._RT_inv * PSI_TO_PA
+        secs_per_psi_in = mols_per_psi * self._inv_flow_in
+        secs_per_psi_out = mols_per_psi * self._inv_flow_out
+        lower = target - self.error_margin
+        upper = target + self.error_margin
 
         # time to start inflating/deflating
-        p_curr = self.check_pressure()
-        self.logger.info(f"Time to start reaching the target pressure: {p_curr}{units} -> {target}{units}")
+        p_curr = p_curr_pascal * PA_TO_PSI
+        log.info(f"Time to start reaching the target pressure: {p_curr:.0f}{units} -> {target}{units}")
         time_taken = 0
         rounds = 0
-        mol_curr = None
+        attempts = 0        # actuations expected to land on the target, i.e. not clipped by a step limit
+        # total actuations allowed, twice the control_step_max steps the initial estimate needs plus the
+        # landing attempts, so a bad estimate can't keep pulsing forever
+        secs_per_psi = secs_per_psi_out if p_curr > target else secs_per_psi_in
+        max_steps = self.max_rounds + 2 * math.ceil(abs(target - p_curr) * secs_per_psi / self.control_step_max)
+        pulse = None        # (inflated, duration, pressure before) of the last actuation
         while True:
-            p_curr = self.check_pressure(raw=True)
-            p_curr_pascal = psi_pa(p_curr)
-            self.logger.info(f"Currently at {round(p_curr)}{units}")
-            mol_curr = determine_mols(volume, p_curr_pascal, self.ambient_temperature, self.logger)
+            p_curr = await self.check_pressure(raw=True)
+            # loop messages pass their values as arguments so loguru only formats them when the level is enabled
+            log.info("Currently at {:.0f}{}", p_curr, units)
+
+            if lower <= p_curr <= upper:
+                log.info("Current pressure {}{} is within threshold of {}{} +/- {}",
+                         p_curr, units, target, units, self.error_margin)
+                log.info("Target {}{} reached in {:.2f}s and {} rounds", target, units, time_taken, rounds)
+                return True
+
+            if pulse is not None:
+                inflated, duration, p_before = pulse
+                # pressure change in the direction the last actuation was meant to move it
+                moved = p_curr - p_before if inflated else p_before - p_curr
+                if moved >= MIN_PRESSURE_CHANGE:
+                    # secant update, blend the rate observed over the last actuation into that direction's estimate
+                    observed = duration / moved
+                    if inflated:
+                        secs_per_psi_in = RATE_BLEND * secs_per_psi_in + (1 - RATE_BLEND) * observed
+                    else:
+                        secs_per_psi_out = RATE_BLEND * secs_per_psi_out + (1 - RATE_BLEND) * observed
+                    log.debug("Observed {:.3f}s/{}, now using (in, out) ({:.3f}, {:.3f})s/{}",
+                              observed, units, secs_per_psi_in, secs_per_psi_out, units)
+                elif moved <= -MIN_PRESSURE_CHANGE or duration > MIN_ACTUATION_TIME:
+                    # a stuck valve, dead pump or leak, more pulses won't help. A minimum length pulse can
+                    # legitimately move the pressure by less than the sensor resolves.
+                    log.warning("Stopping at {}{}, a {:.2f}s {} changed the pressure by {:.2f}{}",
+                                p_curr, units, duration, "inflation" if inflated else "deflation",
+                                p_curr - p_before, units)
+                    return False
 
             # inflation/deflation controls
-            flow_rate = None
+            secs_per_psi = None
             apply_change = None
-            if (target - self.error_margin) <= p_curr <= (target + self.error_margin):
-                self.logger.info(f"Current pressure {p_curr}{units} is within threshold of {target}{units} +/- "
-                                 f"{self.error_margin}")
-                self.logger.info(f"Target {target}{units} reached in {round(time_taken, 2)}s and {rounds} rounds")
-                break
+            if attempts >= self.max_rounds:
+                log.warning("Stopping at {}{} after {} attempts to land within {}{} +/- {}",
+                            p_curr, units, attempts, target, units, self.error_margin)
+                return False
+            elif rounds >= max_steps:
+                log.warning("Stopping at {}{} after {} rounds without reaching {}{} +/- {}",
+                            p_curr, units, rounds, target, units, self.error_margin)
+                return False
             elif p_curr > target:
-                flow_rate = self.flow_rate_out
+                secs_per_psi = secs_per_psi_out
                 apply_change = self.deflate
             else:
-                flow_rate = self.flow_rate_in
+                secs_per_psi = secs_per_psi_in
                 apply_change = self.inflate
 
-            est_time = est_time_to_target(p_curr_pascal, target_pascal, mol_curr, flow_rate, self.logger)
-            self.logger.debug(f"Estimated time to target is {round(est_time)}s")
+            est_time = abs((target - p_curr) * secs_per_psi)
+            log.debug("Estimated time to target is {:.2f}s", est_time)
+            # the reading is outside the error margin here, so a tiny estimate means an underestimated rate
+            # rather than an error too small to correct
+            est_time = max(est_time, MIN_ACTUATION_TIME)
+            # re-measure at least every control_step_max seconds rather than committing to a long actuation
+            # estimated from a stale volume, and bound corrections after the first attempt by trim_max. Only a
+            # pulse that neither limit clipped is expected to land, so only those count as attempts.
+            if est_time > self.control_step_max:
+                est_time = self.control_step_max
+            elif attempts and est_time > self.trim_max:
+                est_time = self.trim_max
+            else:
+                attempts += 1
 
             # correct tyre pressure
-            apply_change(est_time)
+            await apply_change(est_time)
+            pulse = (apply_change == self.inflate, est_time, p_curr)
             time_taken += est_time
             rounds += 1
 
-    def determine_current_mol(self, p_curr, p_target):
+    async def determine_current_mol(self, p_curr, p_target):
         """
         Determine the current mol value of the system to be inflated/deflated
-        :return: Number of mols
+        :param p_curr: Current pressure (Pa)
+        :param p_target: Target pressure (Pa)
+        :return: Number of mols and the pressure (Pa) read after the estimation pulse
         """
 
         flow_rate = None
         t = None
         if p_curr > p_target:
-            self.logger.trace(f"Performing initial estimation using deflation for {self.init_deflate_dur}s")
-            flow_rate = self.flow_rate_out
+            self.logger.trace("Performing initial estimation using deflation for {}s", self.init_deflate_dur)
+            # air leaves the system when deflating
+            flow_rate = -self.flow_rate_out
             t = self.init_deflate_dur
-            self.deflate(t, close=True)
+            await self.deflate(t, close=True)
         else:
-            self.logger.trace(f"Performing initial estimation using inflation for {self.init_inflate_dur}s")
+            self.logger.trace("Performing initial estimation using inflation for {}s", self.init_inflate_dur)
             flow_rate = self.flow_rate_in
             t = self.init_inflate_dur
-            self.inflate(t, close=True)
+            await self.inflate(t, close=True)
 
-        p_now = psi_pa(self.check_pressure(raw=True))
+        p_now = await self.check_pressure(raw=True) * PSI_TO_PA
+        if abs(p_now - p_curr) * PA_TO_PSI < MIN_PRESSURE_CHANGE:
+            raise Exception(f"Pressure did not change after {t}s of initial estimation, unable to estimate the volume")
         n0 = determine_mols_pressure_diff(p_curr, p_now, t, flow_rate, self.logger)
 
-        return n0 + (flow_rate * t)
+        return n0 + (flow_rate * t), p_now
+
+    async def _sleep_until(self, deadline):
+        """
+        Sleep until the perf_counter deadline, spinning for the final SPIN_MARGIN so valves aren't held
+        open past their estimated time by sleep overshoot.
+        :param deadline: time.perf_counter() value to return at
+        """
 
-    def inflate(self, duration, close=True):
-        self.open_inlet()
-        time.sleep(self.on_delay + duration)
+        remaining = deadline - time.perf_counter()
+        if remaining > SPIN_MARGIN:
+            await asyncio.sleep(remaining - SPIN_MARGIN)
+        while time.perf_counter() < deadline:
+            pass
 
-        if close:
-            self.close_inlet()
-            # Wait for pressure to stabilise before finishing
-            time.sleep(self.pressure_balance_delay)
+    async def inflate(self, duration, close=True):
+        """
+        Inflate for duration seconds of air flow.
+        :param duration: Time air should flow for (s), excluding the on_delay dead time
+        :param close: Close the inlet afterwards
+        """
 
-    def deflate(self, duration, close=True):
-        self.open_outlet()
-        time.sleep(duration)
+        # on_delay is the latency between opening the inlet and air flowing, only paid when starting from closed
+        dead_time = self.on_delay if self.is_inlet_closed() else 0.0
+        deadline = time.perf_counter() + dead_time + duration
+        with gc_paused():
+            self.open_inlet()
+            await self._sleep_until(deadline)
 
-        if close:
-            self.close_outlet()
-            # Wait for pressure to stabilise before finishing
-            time.sleep(self.pressure_balance_delay)
+            if close:
+                # check_pressure waits out whatever is left of the settle time when the pressure is next read
+                self.close_inlet()
+
+    async def deflate(self, duration, close=True):
+        deadline = time.perf_counter() + duration
+        with gc_paused():
+            self.open_outlet()
+            await self._sleep_until(deadline)
+
+            if close:
+                self.close_outlet()
 
-    def check_pressure(self, raw=False):
-        flow_changed = False
+    async def check_pressure(self, raw=False):
         if self.is_outlet_open():
             self.close_outlet()
-            flow_changed = True
         if self.is_inlet_open():
             self.close_inlet()
-            flow_changed = True
 
-        if flow_changed:
-            # allow pressure to settle
-            time.sleep(self.pressure_balance_delay)
+        # allow pressure to settle, only sleeping for what's left since the last valve change
+        remaining = self._last_valve_change + self.pressure_balance_delay - time.perf_counter()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
 
+        # the air sensor keeps a running average in the background, so this doesn't block on the ADC
         pressure = self.air_sensor.read_sensor()
         if raw:
             return pressure
         else:
             return round(pressure)
 
+    def _set_valve(self, name, open_valve):
+        if self._valve_open[name] != open_valve:
+            (self._relay_on if open_valve else self._relay_off)(name)
+            self._valve_open[name] = open_valve
+            self._last_valve_change = time.perf_counter()
+
     def open_inlet(self):
-        self.relay_controller.set_relay_on(RC_INLET)
+        self._set_valve(RC_INLET, True)
 
     def close_inlet(self):
-        self.relay_controller.set_relay_off(RC_INLET)
+        self._set_valve(RC_INLET, False)
 
     def open_outlet(self):
-        self.relay_controller.set_relay_on(RC_OUTLET)
+        self._set_valve(RC_OUTLET, True)
 
     def close_outlet(self):
-        self.relay_controller.set_relay_off(RC_OUTLET)
+        self._set_valve(RC_OUTLET, False)
 
     def is_outlet_open(self):
-        return self.relay_controller.get_state(RC_OUTLET) == 1
+        return self._valve_open[RC_OUTLET]
 
     def is_inlet_open(self):
-        return self.relay_controller.get_state(RC_INLET) == 1
+        return self._valve_open[RC_INLET]
 
     def is_outlet_closed(self):
-        return self.relay_controller.get_state(RC_INLET) == 0
+        return not self._valve_open[RC_OUTLET]
+
+    def is_inlet_closed(self):
+        return not self._valve_open[RC_INLET]
 
 def main():
 
     compressor = AutoCompressor()
+    previous_governors = set_cpu_governor("performance", compressor.logger)
+    atexit.register(restore_cpu_governors, previous_governors, compressor.logger)
 
     def signal_handler(sig, frame):
         compressor.exit()
@@ -400,7 +699,8 @@ def main():
         target = 44
         compressor.logger.info(f"Attempting to reach a target of {target}PSI")
         time.sleep(1)
-        compressor.reach_target(target)
+        if not compressor.reach_target_sync(target):
+            compressor.logger.error(f"Unable to reach the target of {target}PSI")
     except Exception as error:
         compressor.logger.error("Encountered an error")
         compressor.logger.exception(error)
@@ -1,5 +1,40 @@
+import mmap
+import os
 import RPi.GPIO as GPIO
 
+# bound once so toggling a relay doesn't look it up on the module each time
+_gpio_output = GPIO.output
+
+# BCM283x GPIO registers, relays write these directly through /dev/gpiomem when it can be mapped
+GPIO_MEM = "/dev/gpiomem"
+GPIO_MEM_SIZE = 0x1000
+GPSET0 = 0x1C               # byte offset of the pin output set register for GPIO 0-31
+GPCLR0 = 0x28               # byte offset of the pin output clear register for GPIO 0-31
+# physical header pin to BCM GPIO number, for when GPIO is in BOARD mode. Only holds for header revision 2
+# and later, revision 1 boards wire some of these pins to different GPIOs.
+BOARD_TO_BCM_MIN_REVISION = 2
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25,
+    23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21
+}
+
+def open_gpio_registers():
+    """
+    Map the GPIO registers from /dev/gpiomem
+    :return: Memoryview of the registers as 32 bit words, or None if they can't be mapped
+    """
+
+    try:
+        fd = os.open(GPIO_MEM, os.O_RDWR | os.O_SYNC)
+    except OSError:
+        return None
+    try:
+        return memoryview(mmap.mmap(fd, GPIO_MEM_SIZE)).cast("I")
+    except (OSError, ValueError):
+        return None
+    finally:
+        os.close(fd)
+
 def get_pin_output(state):
     if state:
         return GPIO.HIGH
@@ -13,22 +48,36 @@ class UnknownRegisterError(Exception):
     pass
 
 class Relay:
-    def __init__(self, pin, off_state):
+    def __init__(self, pin, off_state, gpio_registers=None):
         print(f"New Relay with {pin} and off state = {off_state}")
         self.pin = pin
         self.state = None
         self.low = get_pin_output(bool(off_state))
         self.high = get_pin_output(not bool(off_state))
-        # Set to default state
-        GPIO.setup(pin, GPIO.OUT)
-        self.off()
+        bcm = None
+        if gpio_registers is not None:
+            if GPIO.getmode() != GPIO.BOARD:
+                bcm = pin
+            elif GPIO.RPI_INFO["P1_REVISION"] >= BOARD_TO_BCM_MIN_REVISION:
+                bcm = BOARD_TO_BCM.get(pin)
+        if bcm is not None and bcm < 32:
+            # one 32 bit store to the set or clear register instead of a call into RPi.GPIO
+            mask = 1 << bcm
+            self._write = gpio_registers.__setitem__
+            self._on_args = ((GPSET0 if self.high else GPCLR0) // 4, mask)
+            self._off_args = ((GPSET0 if self.low else GPCLR0) // 4, mask)
+        else:
+            self._write = _gpio_output
+            self._on_args = (pin, self.high)
+            self._off_args = (pin, self.low)
+        # the pin is set up in its off state by RelayController.commit
 
     def on(self):
-        GPIO.output(self.pin, self.high)
+        self._write(*self._on_args)
         self.state = 1
 
     def off(self):
-        GPIO.output(self.pin, self.low)
+        self._write(*self._off_args)
         self.state = 0
 
 class RelayController:
@@ -36,6 +85,13 @@ class RelayController:
         self.registers = {}
         self.max_channels = 0
         self.logger = logger
+        # pins and off values of every register, so all relays can be switched off with one GPIO.output
+        self._pins = ()
+        self._off_values = ()
+        # registered relays whose pins haven't been set up yet, only batched until init
+        self._pending = []
+        self._initialised = False
+        self._gpio_registers = open_gpio_registers()
 
     def load_config(self, config):
         self.max_channels = config["max_channels"]
@@ -43,42 +99,88 @@ class RelayController:
             self.registers = config["registers"]
         else:
             self.registers = {}
+        self._update_pins()
         self.logger.info(
             f"Relay Controller configured as (max_channel, registers), ({self.max_channels}, {self.registers})")
 
     def init(self):
+        self.commit()
         self.set_all_relays_off()
+        self._initialised = True
+
+    def commit(self):
+        """
+        Set up the pins of every relay registered since the last commit as outputs starting in their off state,
+        with one GPIO.setup call per distinct off value
+        """
+
+        by_off_value = {}
+        for relay in self._pending:
+            by_off_value.setdefault(relay.low, []).append(relay)
+        for off_value, relays in by_off_value.items():
+            GPIO.setup([relay.pin for relay in relays], GPIO.OUT, initial=off_value)
+            for relay in relays:
+                relay.state = 0
+        self._pending = []
 
     def register(self, name, pin, off_state=0):
         self.logger.info(f"Registering {name} with pin {pin} and off state {off_state}")
         if len(self.registers) <= self.max_channels:
-            self.registers[name] = Relay(pin, off_state)
+            relay = Relay(pin, off_state, self._gpio_registers)
+            self.registers[name] = relay
+            self._pending.append(relay)
+            self._update_pins()
+            if self._initialised:
+                # nothing left to batch with once the controller is running
+                self.commit()
         else:
             raise MaxChannelError(f"Cannot register any more channels")
 
+    def _update_pins(self):
+        relays = self.registers.values()
+        self._pins = tuple(relay.pin for relay in relays)
+        self._off_values = tuple(relay.low for relay in relays)
+
     def has_register(self, name):
-        if self.registers.get(name, False) is False:
+        if name not in self.registers:
             raise UnknownRegisterError(f"Register by name {name} does not exist")
 
+    # the methods below look the register up once and turn a missing name into UnknownRegisterError, rather
+    # than checking has_register first and looking it up again
     def delete(self, name):
-        self.has_register(name)
-        self.registers.pop(name)
+        try:
+            relay = self.registers.pop(name)
+        except KeyError:
+            raise UnknownRegisterError(f"Register by name {name} does not exist") from None
+        if relay in self._pending:
+            self._pending.remove(relay)
+        self._update_pins()
 
     def get_state(self, name):
-        self.has_register(name)
-        return self.registers[name].state
+        try:
+            return self.registers[name].state
+        except KeyError:
+            raise UnknownRegisterError(f"Register by name {name} does not exist") from None
 
     def set_relay_on(self, name):
-        self.has_register(name)
-        self.logger.trace(f"Setting {name} to on")
-        self.registers[name].on()
+        try:
+            relay = self.registers[name]
+        except KeyError:
+            raise UnknownRegisterError(f"Register by name {name} does not exist") from None
+        self.logger.trace("Setting {} to on", name)
+        relay.on()
 
     def set_relay_off(self, name):
-        self.has_register(name)
-        self.logger.trace(f"Setting {name} to off")
-        self.registers[name].off()
+        try:
+            relay = self.registers[name]
+        except KeyError:
+            raise UnknownRegisterError(f"Register by name {name} does not exist") from None
+        self.logger.trace("Setting {} to off", name)
+        relay.off()
 
     def set_all_relays_off(self):
-        self.logger.trace(f"Setting all relay to off")
-        for name in self.registers:
-            self.set_relay_off(name)
\ No newline at end of file
+        self.logger.trace("Setting all relay to off")
+        if self._pins:
+            _gpio_output(self._pins, self._off_values)
+        for relay in self.registers.values():
+            relay.state = 0
\ No newline at end of file
@@ -2,22 +2,11 @@ import RPi.GPIO as GPIO
 import time
 import signal
 import sys
+from itertools import cycle
 from gpiozero import MCP3008
 
 from RelayController import RelayController
 
-class RepeatList:
-    def __init__(self, list_items):
-        self.list = list_items
-        self.index = 0
-
-    def next(self):
-        self.index += 1
-        if self.index > len(self.list) - 1:
-            self.index = 0
-
-        return self.list[self.index]
-
 def setup():
     GPIO.setmode(GPIO.BOARD)
     GPIO.setup(3, GPIO.OUT)
@@ -37,14 +26,18 @@ def relay_test():
 
     relay_controller = setup()
     signal.signal(signal.SIGINT, stop_GPIO)
-    pins = RepeatList([1, 2])
+    pins = cycle([1, 2])
+    # sleep until fixed deadlines so the duty cycle doesn't drift over long runs
+    next_t = time.perf_counter()
     while True:
-        pin = pins.next()
+        pin = next(pins)
         print(f"Toggling to pin {pin}")
         relay_controller.set_high(pin)
-        time.sleep(0.8)
+        next_t += 0.8
+        time.sleep(max(0.0, next_t - time.perf_counter()))
         relay_controller.set_low(pin)
-        time.sleep(2)
+        next_t += 2
+        time.sleep(max(0.0, next_t - time.perf_counter()))
 
 def main():
     air_read = MCP3008(0)